@@ -3,10 +3,22 @@
 # ITG Scalper + Validated Hammer/Engulfing (v4.5)
 # ============================
 
-from flask import Flask, request, jsonify
-from alpaca_trade_api.rest import REST
+from flask import Flask, Response, request
+from flask.json.provider import JSONProvider
+from alpaca_trade_api.rest import REST, APIError
+from alpaca_trade_api.stream import Stream
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from urllib3.util.retry import Retry
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import datetime
-import os, time, pytz, threading, traceback
+import os, sys, hmac, time, redis, queue, atexit, orjson, logging, threading
+import logging.handlers
+from uuid import uuid4
+from zoneinfo import ZoneInfo
 
 # ──────────────────────────────
 # ENV + CLIENT
@@ -15,28 +27,159 @@ ALPACA_KEY_ID = os.getenv("ALPACA_KEY_ID")
 ALPACA_SECRET_KEY = os.getenv("ALPACA_SECRET_KEY")
 ALPACA_BASE_URL = os.getenv("ALPACA_BASE_URL", "https://paper-api.alpaca.markets")
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "chrisbot1501")
+QUOTE_TTL_S = float(os.getenv("QUOTE_TTL_S", "0.25")) # quotes/trades reused for this long
+POSITION_TTL_S = float(os.getenv("POSITION_TTL_S", "0.4")) # positions reused for this long
+REDIS_URL = os.getenv("REDIS_URL") # optional; persists loss cap + stops across restarts
+STATE_TTL_S = 24 * 3600
+USE_STREAM = os.getenv("ALPACA_STREAM", "1") == "1" # websocket quotes/trades for watched symbols
+DATA_FEED = os.getenv("ALPACA_DATA_FEED", "iex")
+HTTP_TIMEOUT_S = float(os.getenv("HTTP_TIMEOUT_S", "5")) # bound every Alpaca REST call
+STREAM_TTL_S = float(os.getenv("STREAM_TTL_S", "2")) # streamed ticks trusted this long, then REST
+POLL_MIN_S = float(os.getenv("POLL_MIN_S", "0.5")) # stop-watcher tick near the stop
+POLL_MAX_S = float(os.getenv("POLL_MAX_S", "5")) # ...and when price is far away
+BREAKER_FAILS = int(os.getenv("BREAKER_FAILS", "5")) # consecutive REST failures before failing fast
+BREAKER_RESET_S = float(os.getenv("BREAKER_RESET_S", "30"))
+TV_WORKERS = int(os.getenv("TV_WORKERS", "16")) # alert handler threads; extra alerts queue
+EXIT_WORKERS = int(os.getenv("EXIT_WORKERS", "8")) # stop-exit threads, separate so alerts can't starve them
+
+class CircuitBreaker:
+    """Open after `fail_max` consecutive failures; fail fast for `reset_s`, then let one call probe."""
+    def __init__(self, fail_max, reset_s):
+        self.fail_max, self.reset_s = fail_max, reset_s
+        self.fails, self.open_until = 0, 0.0 # open_until 0 → closed
+        self.probing = False # half-open: the one probe call is in flight
+        self._lock = threading.Lock() # alert, exit, watcher and stream threads all record
+
+    def is_open(self):
+        # For callers skipping work while Alpaca is down; once reset_s has passed this is False
+        # again so their next call can be the probe
+        with self._lock:
+            return self.probing or time.monotonic() < self.open_until
+
+    def allow(self):
+        """None to fail fast; else whether this call is the half-open probe (pass it to record)."""
+        with self._lock:
+            if not self.open_until:
+                return False
+            if self.probing or time.monotonic() < self.open_until:
+                return None
+            self.probing = True
+            return True
+
+    def record(self, ok, probe=False):
+        with self._lock:
+            if self.open_until and not probe:
+                return # sent before the circuit opened; only the probe decides what happens next
+            self.probing = False
+            if ok:
+                self.fails, self.open_until = 0, 0.0
+                return
+            self.fails += 1
+            if not probe and self.fails < self.fail_max:
+                return
+            self.open_until = time.monotonic() + self.reset_s # a failed probe re-opens immediately
+        if not probe:
+            log(f"🧯 Alpaca circuit open for {self.reset_s:.0f}s")
+
+breaker = CircuitBreaker(BREAKER_FAILS, BREAKER_RESET_S)
+
+class AlpacaAdapter(HTTPAdapter):
+    """Default timeout + circuit breaker for every Alpaca REST call."""
+    def send(self, request, **kwargs):
+        probe = breaker.allow()
+        if probe is None:
+            raise RequestsConnectionError("Alpaca circuit open")
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = HTTP_TIMEOUT_S
+        try:
+            resp = super().send(request, **kwargs)
+        except BaseException:
+            breaker.record(False, probe) # always settle a probe, or the circuit stays half-open
+            raise
+        breaker.record(resp.status_code < 500, probe)
+        return resp
 
 api = REST(ALPACA_KEY_ID, ALPACA_SECRET_KEY, ALPACA_BASE_URL, api_version="v2")
+# Keep-alive pool sized for the watcher + alert threads; urllib3 only retries idempotent verbs
+api._session.mount("https://", AlpacaAdapter(
+    pool_connections=32, pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504], raise_on_status=False)))
+stream = Stream(ALPACA_KEY_ID, ALPACA_SECRET_KEY, base_url=ALPACA_BASE_URL, data_feed=DATA_FEED) if USE_STREAM else None
+rdb = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+EXECUTOR = ThreadPoolExecutor(max_workers=TV_WORKERS, thread_name_prefix="tv")
+EXIT_EXECUTOR = ThreadPoolExecutor(max_workers=EXIT_WORKERS, thread_name_prefix="exit")
+atexit.register(EXECUTOR.shutdown, wait=False)
+atexit.register(EXIT_EXECUTOR.shutdown, wait=False)
+
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
-NY = pytz.timezone("America/New_York")
+app.json = OrjsonProvider(app)
+app.config["MAX_CONTENT_LENGTH"] = 4096 # TradingView alerts are a few hundred bytes; 413 before parsing
+NY = ZoneInfo("America/New_York")
 
 # ──────────────────────────────
 # STATE
 # ──────────────────────────────
-stops, watchers, loss_tracker = {}, {}, {}
+@dataclass(slots=True)
+class StopInfo:
+    stop: float
+    entry: float
+    source: str
+    entry_id: str = "" # client_order_id of the entry buy; "" for stops saved before it was kept
+    qty: float = 0.0
+    filled: bool = False # a position has been seen since the entry order
+    exiting: bool = False # a stop exit is running; cleared when it returns so a held position re-arms
+    stopped: bool = False # the stop has fired; going flat later still counts as a loss
+    rearm_at: float = 0.0 # monotonic time a held position may fire its stop again
+    next_check: float = 0.0 # monotonic time of the watcher's next look
+    qty_check: float = 0.0 # ...and of its next position re-read
+
+stops, loss_tracker = {}, defaultdict(int) # stops: sym -> StopInfo
+watcher = None # single stop-watcher thread serving every symbol in `stops`; exits when empty
+watcher_wake = threading.Event() # set to run the watcher's next sweep now instead of after POLL_MIN_S
+stream_thread = None # runs stream.run(): trade_updates + per-symbol quotes/trades
+order_events = {} # client_order_id -> threading.Event, set when the order reaches a final state
+open_orders = {} # sym -> last Order we submitted, while it may still be working
+inflight = set() # Alerts still being handled; an identical repeat (every field equal) is dropped
+alert_queues = {} # sym -> deque of Alerts waiting; present while that symbol's drain task runs
+exit_locks = {} # sym -> [RLock, users]; one exit/reprice per symbol (re-entered by reprice_limit)
+# Session flags below are only touched by handle_alert, which drain_alerts serializes per symbol
 awaiting_secondary = {} # after an oversized SCALPER_BUY, wait for hammer/engulfing
 first_trade_done = {} # per-symbol session flag: False until the very first trade is taken
+_quote_cache, _trade_cache = {}, {} # sym -> (expires_at, value); see _cached
+_pos_cache = {} # sym -> (expires_at, Position or None when flat); dropped on our own orders
+_pos_locks = {} # sym -> [Lock, users] held while its position is being fetched
+_pos_gen = {} # sym -> token of the fetch in flight; invalidation drops it so that fetch isn't cached
+_refresh_lock = threading.Lock() # held while a snapshot refresh is in flight
 lock = threading.Lock()
 
 # ──────────────────────────────
 # HELPERS
 # ──────────────────────────────
+# Callers only enqueue; a listener thread formats and writes to stdout
+_log_q = queue.SimpleQueue()
+_log_out = logging.StreamHandler(sys.stdout)
+_log_out.setFormatter(logging.Formatter("%(asctime)s | %(message)s", "%H:%M:%S"))
+_log_listener = logging.handlers.QueueListener(_log_q, _log_out)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logger = logging.getLogger("bot")
+logger.addHandler(logging.handlers.QueueHandler(_log_q))
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
 def log(msg):
-    print(f"{datetime.now().strftime('%H:%M:%S')} | {msg}", flush=True)
+    logger.info(msg)
 
 def round_tick(px):
     try:
-        return round(px, 4) if px < 1 else round(px, 2)
+        return round(px, 2 + 2 * (px < 1)) # sub-$1 → 4 dp, else 2 dp
     except Exception:
         return px
 
@@ -48,38 +191,254 @@ def get_float(x, default=0.0):
     except Exception:
         return default
 
+def refresh_snapshots(syms):
+    # One snapshot request returns both the latest quote and the latest trade per symbol
+    snaps = api.get_snapshots(syms)
+    expires = time.monotonic() + QUOTE_TTL_S
+    with lock:
+        for s, snap in snaps.items():
+            q, t = (snap.latest_quote, snap.latest_trade) if snap else (None, None)
+            if q:
+                _quote_cache[s] = (expires, (float(q.bid_price or 0), float(q.ask_price or 0)))
+            if t:
+                _trade_cache[s] = (expires, float(t.price or 0))
+
+def _fresh(cache, sym, now):
+    hit = cache.get(sym)
+    return hit if hit and now < hit[0] else None
+
+def _cached(cache, sym):
+    """Return the cached quote/trade value for sym, refreshing it once stale.
+
+    A refresh also pulls every other stale symbol under stop watch, so all
+    watched symbols share one multi-symbol request instead of one each.
+    """
+    hit = _fresh(cache, sym, time.monotonic())
+    if hit:
+        return hit[1]
+    # Single-flight: threads that miss together wait for one refresh instead of each fetching
+    with _refresh_lock:
+        now = time.monotonic()
+        hit = _fresh(cache, sym, now)
+        if not hit:
+            syms = {sym} | {s for s in list(stops) if not _fresh(cache, s, now)}
+            refresh_snapshots(sorted(syms))
+            hit = cache[sym]
+    return hit[1]
+
 def latest_bid_ask(sym):
     try:
-        q = api.get_latest_quote(sym)
-        return float(q.bidprice or 0), float(q.askprice or 0)
+        return _cached(_quote_cache, sym)
     except Exception:
         return 0.0, 0.0
 
 def last_trade_price(sym):
     try:
-        t = api.get_latest_trade(sym)
-        return float(getattr(t, "price", 0.0) or 0.0)
+        return _cached(_trade_cache, sym)
     except Exception:
         return 0.0
 
+def live_price(sym):
+    # Trade first, else quote (both come from the same snapshot refresh)
+    last = last_trade_price(sym)
+    if last > 0:
+        return last
+    bid, ask = latest_bid_ask(sym)
+    return bid or ask
+
+@contextmanager
+def held(locks, sym, make=threading.Lock):
+    """Hold sym's lock from `locks`; the entry is removed once no thread holds or waits on it."""
+    with lock:
+        ent = locks.get(sym)
+        if ent is None:
+            ent = locks[sym] = [make(), 0]
+        ent[1] += 1
+    try:
+        with ent[0]:
+            yield
+    finally:
+        with lock:
+            ent[1] -= 1
+            if not ent[1]:
+                del locks[sym]
+
+def fetch_position(sym):
+    """Uncached position read: None when flat, other errors raise."""
+    try:
+        return api.get_position(sym)
+    except APIError as e:
+        if e.status_code != 404:
+            raise
+        return None # no open position
+
+def invalidate_position(sym):
+    # Our own order changed sym's position: drop the cached read and any fetch already in flight
+    with lock:
+        _pos_gen.pop(sym, None)
+        _pos_cache.pop(sym, None)
+
+def _pos_fetch_start(syms):
+    with lock:
+        return {s: _pos_gen.setdefault(s, object()) for s in syms}
+
+def _pos_fetch_end(gens, now, got):
+    # Cache each symbol whose token survived (not invalidated since the fetch began); got is
+    # None when the fetch failed. Tokens are dropped here, so _pos_gen holds only fetches in flight.
+    with lock:
+        for s, gen in gens.items():
+            if _pos_gen.get(s) is gen:
+                del _pos_gen[s]
+                if got is not None:
+                    _pos_cache[s] = (now + POSITION_TTL_S, got.get(s))
+
+def get_position(sym):
+    """Position for sym (None when flat), shared by safe_qty/avg_entry_price for POSITION_TTL_S."""
+    hit = _fresh(_pos_cache, sym, time.monotonic())
+    if hit:
+        return hit[1]
+    with held(_pos_locks, sym): # single-flight per symbol, as in _cached
+        now = time.monotonic()
+        hit = _fresh(_pos_cache, sym, now)
+        if hit:
+            return hit[1]
+        gens, got = _pos_fetch_start([sym]), None
+        try:
+            pos = fetch_position(sym)
+            got = {sym: pos}
+        finally:
+            _pos_fetch_end(gens, now, got)
+        return pos
+
+def refresh_positions(syms):
+    # One list_positions call fills _pos_cache for syms (None when flat); a symbol invalidated
+    # while the call was in flight keeps its invalidation
+    now = time.monotonic()
+    gens, got = _pos_fetch_start(syms), None
+    try:
+        got = {p.symbol: p for p in api.list_positions()}
+    finally:
+        _pos_fetch_end(gens, now, got)
+
 def safe_qty(sym):
     try:
-        return float(api.get_position(sym).qty)
+        pos = get_position(sym)
+        return float(pos.qty) if pos else 0.0
     except Exception:
         return 0.0
 
 def avg_entry_price(sym):
     try:
-        return float(api.get_position(sym).avg_entry_price)
+        pos = get_position(sym)
+        return float(pos.avg_entry_price) if pos else 0.0
     except Exception:
         return 0.0
 
 def cancel_all(sym):
+    # Our working order is tracked, so cancel it by id; list open orders when we have none on
+    # record (e.g. left over from before a restart) or the record was stale and the cancel failed
+    with lock:
+        prev = open_orders.pop(sym, None)
+    invalidate_position(sym)
+    if prev:
+        try:
+            api.cancel_order(prev.id)
+            return
+        except Exception as e:
+            log(f"⚠️ cancel_order {sym} {prev.id}: {e} → cancel open orders")
     try:
-        for o in api.list_orders(status="open", symbols=[sym]):
-            api.cancel_order(o.id)
-    except Exception:
-        pass
+        oids = [o.id for o in api.list_orders(status="open", symbols=[sym])]
+    except Exception as e:
+        log(f"⚠️ list_orders {sym}: {e}")
+        return
+    for oid in oids:
+        try:
+            api.cancel_order(oid)
+        except Exception as e:
+            log(f"⚠️ cancel_order {sym} {oid}: {e}")
+
+# ──────────────────────────────
+# STREAM (websocket ticks keep the quote/trade caches warm; REST is the fallback)
+# ──────────────────────────────
+FINAL_ORDER_EVENTS = {"fill", "canceled", "expired", "rejected", "done_for_day", "replaced"}
+DEAD_ORDER_STATES = {"canceled", "expired", "rejected", "done_for_day"} # events and order statuses
+
+async def on_quote(q):
+    _quote_cache[q.symbol] = (time.monotonic() + STREAM_TTL_S, (float(q.bid_price or 0), float(q.ask_price or 0)))
+
+async def on_trade(t):
+    px = float(t.price or 0)
+    _trade_cache[t.symbol] = (time.monotonic() + STREAM_TTL_S, px)
+    # Evaluate the stop on the tick itself; the watcher sweep stays as the REST fallback
+    info = stops.get(t.symbol)
+    if info and info.filled and px > 0:
+        trigger_stop(t.symbol, info, px)
+
+async def on_trade_update(u):
+    if u.event in ("fill", "partial_fill"):
+        # Position changed: make the watcher re-read it on its next sweep
+        invalidate_position(u.order.get("symbol"))
+        info = stops.get(u.order.get("symbol"))
+        if info:
+            info.next_check = info.qty_check = 0
+            watcher_wake.set()
+    if u.event in DEAD_ORDER_STATES:
+        # Entry buy ended without a fill: there is no position for its stop to protect
+        info = stops.get(u.order.get("symbol"))
+        if info and info.entry_id == u.order.get("client_order_id") and not float(u.order.get("filled_qty") or 0):
+            EXIT_EXECUTOR.submit(drop_stop, u.order.get("symbol"), info) # (un)subscribing blocks this loop
+        elif info and u.order.get("side") == "sell":
+            with lock: # the stop sell ended unfilled: a later flat is not the stop's loss
+                if not info.exiting:
+                    info.stopped = False
+    if u.event in FINAL_ORDER_EVENTS:
+        o = u.order
+        with lock: # same lock submit/reprice hold to record an order, so a final event can't be undone
+            cur = open_orders.get(o.get("symbol"))
+            if cur and cur.id == o.get("id"):
+                open_orders.pop(o.get("symbol"), None)
+            ev = order_events.pop(o.get("client_order_id"), None)
+            if ev:
+                ev.set()
+
+def stream_alive():
+    t = stream_thread
+    return bool(t and t.is_alive())
+
+def start_stream():
+    # Called at import and again by the watcher: stream.run() can return or die, and a fresh
+    # run resubscribes every handler still registered
+    global stream_thread
+    if not stream:
+        return
+    with lock:
+        if stream_alive():
+            return
+        if stream_thread:
+            log("♻️ Stream thread ended; restarting")
+        stream.subscribe_trade_updates(on_trade_update)
+        stream_thread = threading.Thread(target=stream.run, daemon=True)
+        stream_thread.start()
+
+def stream_subscribe(sym):
+    if not stream:
+        return
+    try:
+        stream.subscribe_quotes(on_quote, sym)
+        stream.subscribe_trades(on_trade, sym)
+    except Exception as e:
+        log(f"⚠️ stream subscribe {sym}: {e}")
+
+def stream_unsubscribe(sym):
+    if not stream:
+        return
+    try:
+        stream.unsubscribe_quotes(sym)
+        stream.unsubscribe_trades(sym)
+    except KeyError:
+        pass # was never subscribed
+    except Exception as e:
+        log(f"⚠️ stream unsubscribe {sym}: {e}")
 
 # ──────────────────────────────
 # STOP / LOSS
@@ -90,36 +449,151 @@ def get_stop(entry_price, signal_low):
 
 def record_loss(sym):
     with lock:
-        loss_tracker[sym] = loss_tracker.get(sym, 0) + 1
-        if loss_tracker[sym] >= 2:
-            log(f"🚫 {sym} locked after 2 losses")
+        loss_tracker[sym] += 1
+    if rdb:
+        try:
+            key = loss_key()
+            n, _ = rdb.pipeline().hincrby(key, sym, 1).expire(key, STATE_TTL_S).execute()
+            with lock:
+                loss_tracker[sym] = max(loss_tracker[sym], int(n))
+        except Exception as e:
+            log(f"⚠️ redis record_loss {sym}: {e}")
+    if loss_tracker[sym] >= 2:
+        log(f"🚫 {sym} locked after 2 losses")
 
 def can_trade(sym):
     return loss_tracker.get(sym, 0) < 2
 
+# ──────────────────────────────
+# PERSISTENCE (Redis, only when REDIS_URL is set)
+# ──────────────────────────────
+def loss_key():
+    # One hash per NY session day so the loss cap resets with the session
+    return f"loss_count:{datetime.now(NY).date()}"
+
+def save_stop(sym, info):
+    with lock:
+        stops[sym] = info
+    if rdb:
+        try:
+            data = {"stop": info.stop, "entry": info.entry, "source": info.source, "entry_id": info.entry_id}
+            rdb.setex(f"stops:{sym}", STATE_TTL_S, orjson.dumps(data))
+        except Exception as e:
+            log(f"⚠️ redis save_stop {sym}: {e}")
+
+def drop_stop(sym, info=None):
+    """Forget sym's stop; with `info`, only if it is still the current entry. True if one was dropped."""
+    with lock:
+        if info is not None and stops.get(sym) is not info:
+            return False
+        if stops.pop(sym, None) is None:
+            return False
+    watcher_wake.set()
+    stream_unsubscribe(sym)
+    if rdb:
+        try:
+            rdb.delete(f"stops:{sym}")
+        except Exception as e:
+            log(f"⚠️ redis drop_stop {sym}: {e}")
+    return True
+
+def restore_state():
+    if not rdb:
+        return
+    try:
+        losses = {k.decode(): int(v) for k, v in rdb.hgetall(loss_key()).items()}
+        saved = {}
+        for key in rdb.scan_iter("stops:*"):
+            raw = rdb.get(key)
+            if raw:
+                d = orjson.loads(raw)
+                saved[key.decode().split(":", 1)[1]] = StopInfo(d["stop"], d["entry"], d["source"], d.get("entry_id", ""))
+    except Exception as e:
+        log(f"⚠️ redis restore_state: {e}")
+        return
+    with lock:
+        loss_tracker.update(losses)
+        stops.update(saved)
+    for sym, info in saved.items():
+        ensure_watcher(sym, info.source)
+    log(f"♻️ Restored {len(losses)} loss counts, {len(saved)} stops from Redis")
+
 # ──────────────────────────────
 # ORDER + PnL
 # ──────────────────────────────
-def submit_limit(side, sym, qty, px):
+def exit_lock(sym):
+    return held(exit_locks, sym, threading.RLock)
+
+def track_order(coid):
+    # Set by trade_updates once the order is final; with the stream off nothing sets it,
+    # so waiting on it is just a timeout
+    ev = threading.Event()
+    if stream_alive():
+        order_events[coid] = ev
+    return ev
+
+def keep_order(sym, order, ev):
+    # The final event may arrive before the submit returns: don't record an order that's done
+    with lock:
+        if not ev.is_set():
+            open_orders[sym] = order
+
+def submit_limit(side, sym, qty, px, coid=None):
+    """Submit a day limit order; returns an Event set once it is final, or None if the submit failed."""
+    coid = coid or uuid4().hex
+    ev = track_order(coid)
+    invalidate_position(sym)
+    q, lp = int(qty), round_tick(px)
     try:
-        api.submit_order(
+        order = api.submit_order(
             symbol=sym,
-            qty=int(qty),
+            qty=q,
             side=side,
             type="limit",
-            limit_price=round_tick(px),
+            limit_price=lp,
             time_in_force="day",
+            client_order_id=coid,
             extended_hours=True
         )
-        log(f"📥 {side.upper()} LIMIT {sym} @ {round_tick(px)} x{int(qty)}")
+        keep_order(sym, order, ev)
+        log(f"📥 {side.upper()} LIMIT {sym} @ {lp} x{q}")
+        return ev
     except Exception as e:
+        order_events.pop(coid, None)
         log(f"⚠️ submit_limit {sym}: {e}")
 
-def update_pnl(sym, exit_price, source):
+def reprice_limit(side, sym, qty, px):
+    """Move our working `side` order for sym to px with one PATCH; else cancel + resubmit."""
+    # Read → replace or cancel + submit → record runs as one step per symbol, so two callers
+    # can't both see the same order and each place a sell of their own
+    with exit_lock(sym):
+        prev, q, lp = open_orders.get(sym), int(qty), round_tick(px)
+        if prev and prev.side == side and int(float(prev.qty)) == q:
+            if float(prev.limit_price or 0) == lp:
+                # Already working at this price (a re-fired stop): keep its queue spot, wait on it again
+                return order_events.get(prev.client_order_id) or threading.Event()
+            coid = uuid4().hex
+            ev = track_order(coid)
+            invalidate_position(sym)
+            try:
+                keep_order(sym, api.replace_order(prev.id, limit_price=lp, client_order_id=coid), ev)
+                log(f"🔁 {side.upper()} LIMIT {sym} → {lp} x{q}")
+                return ev
+            except Exception as e:
+                # 422/404: already filled, canceled or replaced
+                order_events.pop(coid, None)
+                log(f"⚠️ replace_order {sym}: {e} → cancel + resubmit")
+        cancel_all(sym)
+        return submit_limit(side, sym, qty, px)
+
+def update_pnl(sym, exit_price, source, avg, qty):
+    # avg/qty are read before the sell: once flat there is no position left to read
+    if not avg or avg <= 0: # entry price unknown: the whole sale is not profit
+        log(f"💰 {sym} EXIT ({source}) @ {exit_price:.4f} | PnL n/a (entry price unknown)")
+        return
     try:
-        avg, qty = avg_entry_price(sym), safe_qty(sym)
         pnl_d = (exit_price - avg) * qty
-        pnl_p = ((exit_price / avg) - 1) * 100 if avg > 0 else 0
+        pnl_p = ((exit_price / avg) - 1) * 100
         log(f"💰 {sym} EXIT ({source}) @ {exit_price:.4f} | PnL ${pnl_d:.2f} ({pnl_p:.2f}%)")
     except Exception:
         log(f"💰 {sym} EXIT ({source}) @ {exit_price}")
@@ -129,59 +603,137 @@ def update_pnl(sym, exit_price, source):
 # ──────────────────────────────
 def managed_exit(sym, qty_hint, target_price=None, mark_stop_loss=False, source="GENERIC"):
     try:
-        qty = safe_qty(sym) or qty_hint
+        avg, qty = avg_entry_price(sym), safe_qty(sym) or qty_hint
         if qty <= 0:
             return
-        bid, ask = latest_bid_ask(sym)
-        px = round_tick(target_price or bid or ask)
+        px = target_price
+        if not px: # only read the book when no exit price was given
+            bid, ask = latest_bid_ask(sym)
+            px = bid or ask
+        px = round_tick(px)
         if px <= 0:
             return
-        cancel_all(sym)
-        submit_limit("sell", sym, qty, px)
-        time.sleep(5)
-        if safe_qty(sym) <= 0:
-            update_pnl(sym, px, source)
-            with lock:
-                stops.pop(sym, None)
-            if mark_stop_loss:
+        done = reprice_limit("sell", sym, qty, px)
+        if not done:
+            return # no sell was placed
+        # Wake as soon as trade_updates reports the sell final; 5s cap either way
+        done.wait(5)
+        pos = fetch_position(sym) # uncached, raises on errors: only a confirmed flat read closes the stop
+        if not pos or float(pos.qty) <= 0:
+            update_pnl(sym, px, source, avg, qty)
+            if drop_stop(sym) and mark_stop_loss:
                 record_loss(sym)
     except Exception as e:
-        log(f"❌ managed_exit {sym}: {e}\n{traceback.format_exc()}")
+        logger.exception(f"❌ managed_exit {sym}: {e}")
 
 # ──────────────────────────────
-# STOP WATCHER (pre-market safe; polls Alpaca live prices)
+# STOP WATCHER (pre-market safe; stream ticks trigger stops, one thread polls as fallback)
 # ──────────────────────────────
-def stop_watcher(sym, source):
-    log(f"👀 Watching stop for {sym} ({source})")
+def poll_interval(live, stop_price):
+    # Seconds until the next check: tight near the stop, loose when far from it
+    dist = abs(live - stop_price) / live
+    return min(max(dist * 60, POLL_MIN_S), POLL_MAX_S)
+
+def qty_due(info, now):
+    # Position is re-read until the entry fills, then only every POLL_MAX_S
+    return not info.filled or now >= info.qty_check
+
+def entry_ended(info):
+    # trade_updates normally reports this first; asking covers a missed event or ALPACA_STREAM=0
+    if not info.entry_id:
+        return False
+    o = api.get_order_by_client_order_id(info.entry_id)
+    return o.status in DEAD_ORDER_STATES and not float(o.filled_qty or 0)
+
+def check_stop(sym, info, now):
+    if info.exiting or now < info.next_check:
+        return
+    info.next_check = now + POLL_MAX_S
+
+    if qty_due(info, now):
+        pos = get_position(sym) # raises on errors, unlike safe_qty: unknown must not read as flat
+        qty = float(pos.qty) if pos else 0.0
+        if qty <= 0:
+            # Filled then flat → closed elsewhere; entry ended unfilled → nothing to protect;
+            # otherwise the entry limit is still working → keep waiting
+            if (info.filled or entry_ended(info)) and drop_stop(sym, info) and info.stopped:
+                record_loss(sym) # our stop sell filled after managed_exit stopped waiting
+            return
+        info.filled, info.qty, info.qty_check = True, qty, now + POLL_MAX_S
+
+    live = live_price(sym)
+    if live <= 0:
+        return
+    info.next_check = now + poll_interval(live, info.stop)
+
+    trigger_stop(sym, info, live)
+
+def trigger_stop(sym, info, live):
+    # Called from both the watcher sweep and the trade stream; only the first caller exits
+    stop_price, source = info.stop, info.source
+    if breaker.is_open():
+        return # the sell would fail fast; stay armed for the first tick after Alpaca recovers
+    with lock:
+        if live > stop_price or info.exiting or time.monotonic() < info.rearm_at:
+            return
+        info.exiting = info.stopped = True
+    log(f"🛑 Stop triggered for {sym} ({source}) — live {live} ≤ stop {stop_price}")
+    # Tiny buffer to help fill a limit in pre-market
+    sell_px = round_tick(stop_price * 0.999)
+    EXIT_EXECUTOR.submit(stop_exit, sym, info, sell_px)
+
+def stop_exit(sym, info, sell_px):
+    try:
+        with exit_lock(sym): # an EXIT alert may be selling sym now; wait rather than race its order
+            if stops.get(sym) is info: # ...and if that sold out, the stop is gone: nothing to sell
+                managed_exit(sym, info.qty, sell_px, True, info.source)
+    finally:
+        # Flat → the stop is already dropped; still held (sell failed or unfilled) → re-arm,
+        # paced so a persistently rejected sell isn't resent on every tick. Only a stop sell
+        # still working can go on to fill as the loss; with none, a later flat is another exit
+        with lock:
+            o = open_orders.get(sym)
+            info.stopped = bool(o and o.side == "sell")
+            info.rearm_at = time.monotonic() + POLL_MIN_S
+            info.exiting = False
+
+def stop_watcher():
+    global watcher
     while True:
-        time.sleep(2) # poll every 2s
-        info = stops.get(sym)
-        if not info or safe_qty(sym) <= 0:
-            break
-
-        stop_price = info["stop"]
-
-        # Live price from Alpaca (trade first, else quote)
-        last = last_trade_price(sym)
-        bid, ask = latest_bid_ask(sym)
-        live = last or bid or ask
-        if live <= 0:
-            continue
-
-        if live <= stop_price:
-            log(f"🛑 Stop triggered for {sym} ({source}) — live {live} ≤ stop {stop_price}")
-            # Tiny buffer to help fill a limit in pre-market
-            sell_px = round_tick(stop_price * 0.999)
-            managed_exit(sym, safe_qty(sym), sell_px, True, source)
-            break
+        watcher_wake.wait(POLL_MIN_S)
+        watcher_wake.clear()
+        with lock:
+            if not stops:
+                watcher = None # ensure_watcher starts a fresh one with the next stop
+                return
+        start_stream() # no-op while it runs; stops rely on its ticks and fill events
+        if breaker.is_open():
+            continue # Alpaca unreachable: skip rather than read errors as flat positions
+        now = time.monotonic()
+        items = list(stops.items())
+        due = [s for s, i in items if not i.exiting and now >= i.next_check and qty_due(i, now)]
+        if due:
+            try:
+                refresh_positions(due)
+            except Exception as e:
+                log(f"❌ stop_watcher positions: {e}")
+                continue
+        for sym, info in items:
+            try:
+                check_stop(sym, info, now)
+            except Exception as e:
+                log(f"❌ stop_watcher {sym}: {e}")
 
 def ensure_watcher(sym, source):
+    global watcher
+    log(f"👀 Watching stop for {sym} ({source})")
+    start_stream()
+    stream_subscribe(sym)
     with lock:
-        if sym in watchers and watchers[sym].is_alive():
+        if watcher and watcher.is_alive():
             return
-        t = threading.Thread(target=stop_watcher, args=(sym, source), daemon=True)
-        watchers[sym] = t
-        t.start()
+        watcher = threading.Thread(target=stop_watcher, daemon=True)
+        watcher.start()
 
 # ──────────────────────────────
 # TRADE LOGIC
@@ -192,19 +744,27 @@ def valid_candle_range(close_p, low_p):
     return rng <= 11, rng
 
 def execute_buy(sym, qty, entry_price, signal_low, source):
-    if not can_trade(sym) or safe_qty(sym) > 0:
+    # Local gates first (dict lookup, arithmetic); the position REST call only if they pass
+    if not can_trade(sym):
         log(f"⚠️ Skipping BUY {sym} ({source}) — locked or already in position")
         return
     ok, rng = valid_candle_range(entry_price, signal_low)
     if not ok:
         log(f"⚠️ Skipping BUY {sym} ({source}) — invalid candle range {rng:.2f}%")
         return
+    if safe_qty(sym) > 0:
+        log(f"⚠️ Skipping BUY {sym} ({source}) — locked or already in position")
+        return
 
     stop = get_stop(entry_price, signal_low) # always signal low
     log(f"🟢 BUY {sym} ({source}) @ {entry_price} | Stop (signal low) {stop}")
-    submit_limit("buy", sym, qty, entry_price)
-    with lock:
-        stops[sym] = {"stop": stop, "entry": entry_price}
+    prev = open_orders.get(sym)
+    if prev and prev.side == "buy":
+        cancel_all(sym) # a newer BUY replaces the entry still working, which would be left untracked
+    info = StopInfo(stop, entry_price, source, uuid4().hex)
+    if not submit_limit("buy", sym, qty, entry_price, coid=info.entry_id):
+        return # nothing working, so no stop to watch
+    save_stop(sym, info)
     ensure_watcher(sym, source)
 
 # ──────────────────────────────
@@ -212,108 +772,195 @@ def execute_buy(sym, qty, entry_price, signal_low, source):
 # ──────────────────────────────
 BUY_SOURCES_SCALPER = {"SCALPER_BUY"}
 BUY_SOURCES_HAM_ENG = {"HAMMER_EMA5", "ENGULFING_EMA5"}
+@dataclass(slots=True, frozen=True) # frozen → hashable, so the whole alert is its dedupe key
+class Alert:
+    sym: str
+    act: str # "BUY"/"ADD"/"EXIT"
+    src: str
+    qty: float
+    close: float
+    low: float
+    exit_price: float
+
+def parse_alert(d):
+    return Alert(
+        sym=sys.intern(str(d.get("ticker") or "").upper()), # one shared key object per ticker
+        act=str(d.get("action") or "").upper(),
+        src=str(d.get("source") or "GENERIC").upper(),
+        qty=get_float(d.get("quantity", 100)),
+        close=get_float(d.get("signal_close")),
+        low=get_float(d.get("signal_low")),
+        exit_price=get_float(d.get("exit_price")),
+    )
+
+def on_exit(a):
+    sym, src = a.sym, a.src
+    # After any exit, we DO NOT reset first_trade_done.
+    # Session stays in "scalper-first" mode permanently after the first trade of the day.
+    with exit_lock(sym): # a stop exit runs off the alert path; one sell per symbol at a time
+        managed_exit(sym= sym, qty_hint= a.qty, target_price= a.exit_price, mark_stop_loss= False, source= src)
+    # Clear awaiting_secondary just to be safe for next cycle
+    awaiting_secondary.pop(sym, None)
+
+def on_buy(a):
+    # ADD is handled like BUY (scale-ins treated like entries)
+    sym, src, qty, close_p, low_p = a.sym, a.src, a.qty, a.close, a.low
+
+    # 1) BEFORE FIRST TRADE: allow any of the three (Scalper or Hammer/Engulfing)
+    if not first_trade_done.get(sym, False):
+        if src in BUY_SOURCES_SCALPER:
+            ok, _ = valid_candle_range(close_p, low_p)
+            if ok:
+                execute_buy(sym, qty, close_p, low_p, src)
+                first_trade_done[sym] = True
+                awaiting_secondary.pop(sym, None)
+            else:
+                log(f"⚠️ SCALPER {sym} too large → awaiting valid Hammer/Engulfing for FIRST trade")
+                awaiting_secondary[sym] = True
+        elif src in BUY_SOURCES_HAM_ENG:
+            # If we were awaiting due to oversized scalper, or even if not, first trade can be hammer/engulfing
+            execute_buy(sym, qty, close_p, low_p, src)
+            first_trade_done[sym] = True
+            awaiting_secondary.pop(sym, None)
+        else:
+            log(f"⚠️ Unknown source '{src}' for first trade BUY")
+        return
+
+    # 2) AFTER FIRST TRADE: must start with SCALPER; hammer/engulfing only as secondary
+    if src in BUY_SOURCES_SCALPER:
+        ok, _ = valid_candle_range(close_p, low_p)
+        if ok:
+            execute_buy(sym, qty, close_p, low_p, src)
+            awaiting_secondary.pop(sym, None)
+        else:
+            log(f"⚠️ SCALPER {sym} too large → awaiting valid Hammer/Engulfing (secondary)")
+            awaiting_secondary[sym] = True
+    elif src in BUY_SOURCES_HAM_ENG:
+        if awaiting_secondary.pop(sym, None):
+            log(f"🟢 Secondary entry unlocked — {src} for {sym}")
+            execute_buy(sym, qty, close_p, low_p, src)
+        else:
+            log(f"⚠️ Ignoring {src} for {sym} — post-first trade requires SCALPER first")
+    else:
+        log(f"⚠️ Unknown source '{src}' for BUY")
 
-def handle_alert(data):
+ALERT_ACTIONS = {"BUY": on_buy, "ADD": on_buy, "EXIT": on_exit}
+
+def handle_alert(a):
     try:
-        sym = (data.get("ticker") or "").upper()
-        act = (data.get("action") or "").upper() # "BUY"/"ADD"/"EXIT"
-        src = (data.get("source") or "GENERIC").upper()
-        qty = get_float(data.get("quantity", 100))
-        close_p = get_float(data.get("signal_close", 0))
-        low_p = get_float(data.get("signal_low", 0))
-        exit_p = get_float(data.get("exit_price", 0))
+        sym, act, src = a.sym, a.act, a.src
 
         if not sym:
             log("⚠️ Missing ticker; ignoring alert")
             return
 
         # If action is blank but source implies a buy, treat as BUY
-        if act not in {"BUY", "ADD", "EXIT"} and (src in BUY_SOURCES_SCALPER or src in BUY_SOURCES_HAM_ENG):
+        if act not in ALERT_ACTIONS and (src in BUY_SOURCES_SCALPER or src in BUY_SOURCES_HAM_ENG):
             act = "BUY"
+        handler = ALERT_ACTIONS.get(act)
+        if not handler:
+            log(f"⚠️ Unknown action/source combo: action={act} source={src}")
+            return
+
+        # Locked symbols stop here, before any quote/position request or session-flag change
+        if handler is on_buy and not can_trade(sym):
+            log(f"⚠️ Skipping {act} {sym} ({src}) — locked after 2 losses")
+            return
 
         # Log context
-        if act == "EXIT":
+        if handler is on_exit:
             log(f"🚀 EXIT signal for {sym} ({src})")
         else:
-            rng = (close_p - low_p) / close_p * 100 if close_p else 0
+            rng = (a.close - a.low) / a.close * 100 if a.close else 0
             log(f"🚀 {act} signal for {sym} ({src}) | range {rng:.2f}% | first_trade_done={first_trade_done.get(sym, False)}")
 
-        # ─── EXIT ───
-        if act == "EXIT":
-            # After any exit, we DO NOT reset first_trade_done.
-            # Session stays in "scalper-first" mode permanently after the first trade of the day.
-            managed_exit(sym= sym, qty_hint= qty, target_price= exit_p, mark_stop_loss= False, source= src)
-            # Clear awaiting_secondary just to be safe for next cycle
-            awaiting_secondary.pop(sym, None)
-            return
+        handler(a)
 
-        # ─── BUY/ADD paths ───
-        # Normalize ADD to BUY behavior (scale-ins treated like entries)
-        if act in {"BUY", "ADD"}:
-            # 1) BEFORE FIRST TRADE: allow any of the three (Scalper or Hammer/Engulfing)
-            if not first_trade_done.get(sym, False):
-                if src in BUY_SOURCES_SCALPER:
-                    ok, _ = valid_candle_range(close_p, low_p)
-                    if ok:
-                        execute_buy(sym, qty, close_p, low_p, src)
-                        first_trade_done[sym] = True
-                        awaiting_secondary.pop(sym, None)
-                    else:
-                        log(f"⚠️ SCALPER {sym} too large → awaiting valid Hammer/Engulfing for FIRST trade")
-                        awaiting_secondary[sym] = True
-                elif src in BUY_SOURCES_HAM_ENG:
-                    # If we were awaiting due to oversized scalper, or even if not, first trade can be hammer/engulfing
-                    execute_buy(sym, qty, close_p, low_p, src)
-                    first_trade_done[sym] = True
-                    awaiting_secondary.pop(sym, None)
-                else:
-                    log(f"⚠️ Unknown source '{src}' for first trade BUY")
-                return
+    except Exception as e:
+        logger.exception(f"❌ handle_alert {e}")
 
-            # 2) AFTER FIRST TRADE: must start with SCALPER; hammer/engulfing only as secondary
-            else:
-                if src in BUY_SOURCES_SCALPER:
-                    ok, _ = valid_candle_range(close_p, low_p)
-                    if ok:
-                        execute_buy(sym, qty, close_p, low_p, src)
-                        awaiting_secondary.pop(sym, None)
-                    else:
-                        log(f"⚠️ SCALPER {sym} too large → awaiting valid Hammer/Engulfing (secondary)")
-                        awaiting_secondary[sym] = True
-                    return
-
-                if src in BUY_SOURCES_HAM_ENG:
-                    if awaiting_secondary.get(sym):
-                        log(f"🟢 Secondary entry unlocked — {src} for {sym}")
-                        awaiting_secondary.pop(sym, None)
-                        execute_buy(sym, qty, close_p, low_p, src)
-                    else:
-                        log(f"⚠️ Ignoring {src} for {sym} — post-first trade requires SCALPER first")
-                    return
-
-                log(f"⚠️ Unknown source '{src}' for BUY")
+def queue_alert(a):
+    """Queue a for its symbol; False if an identical alert is still being handled."""
+    with lock:
+        if a in inflight:
+            return False
+        inflight.add(a)
+        q = alert_queues.get(a.sym)
+        if q is not None:
+            q.append(a) # that symbol's drain task picks it up
+            return True
+        alert_queues[a.sym] = deque((a,))
+    EXECUTOR.submit(drain_alerts, a.sym)
+    return True
+
+def drain_alerts(sym):
+    # One task per symbol runs its alerts in order, so a BUY and an ADD can't both see a flat
+    # position and submit. A slow symbol holds one worker; nothing parks waiting on a lock.
+    while True:
+        with lock:
+            q = alert_queues[sym]
+            if not q:
+                del alert_queues[sym]
                 return
-
-        # Fallback
-        log(f"⚠️ Unknown action/source combo: action={act} source={src}")
-
-    except Exception as e:
-        log(f"❌ handle_alert {e}\n{traceback.format_exc()}")
+            a = q.popleft()
+        try:
+            handle_alert(a)
+        finally:
+            with lock:
+                inflight.discard(a)
 
 # ──────────────────────────────
 # WEBHOOKS
 # ──────────────────────────────
+# Response bodies never change, so they are serialized once at import
+_OK = orjson.dumps({"ok": True})
+_DUPLICATE = orjson.dumps({"ok": True, "duplicate": True})
+_BAD_SECRET = orjson.dumps({"error": "Invalid secret"})
+_PING = orjson.dumps({"ok": True, "service": "tv→alpaca", "base": ALPACA_BASE_URL})
+
+_SECRET = WEBHOOK_SECRET.encode()
+
+def reply(body, status=200):
+    return Response(body, status=status, mimetype="application/json")
+
+def secret_ok(s):
+    # Constant-time, so response timing doesn't leak how much of the secret matched
+    return isinstance(s, str) and hmac.compare_digest(s.encode(), _SECRET)
+
 @app.post("/tv")
 def tv():
-    d = request.get_json(silent=True) or {}
-    if d.get("secret") != WEBHOOK_SECRET:
-        return jsonify(error="Invalid secret"), 403
-    threading.Thread(target=handle_alert, args=(d,), daemon=True).start()
-    return jsonify(ok=True)
+    # TradingView can't set headers, so the secret normally rides in the body. Other
+    # callers may send X-Webhook-Secret and get rejected before the JSON is parsed.
+    hdr = request.headers.get("X-Webhook-Secret")
+    if hdr is not None and not secret_ok(hdr):
+        return reply(_BAD_SECRET, 403)
+    d = request.get_json(silent=True)
+    if not isinstance(d, dict):
+        d = {}
+    if hdr is None and not secret_ok(d.get("secret")):
+        return reply(_BAD_SECRET, 403)
+    a = parse_alert(d)
+    # TradingView can double-fire; an identical alert still being handled is a duplicate.
+    # Prices and qty are part of the match, so a new signal for the same ticker still runs.
+    if not queue_alert(a):
+        return reply(_DUPLICATE)
+    return reply(_OK)
 
 @app.get("/ping")
 def ping():
-    return jsonify(ok=True, service="tv→alpaca", base=ALPACA_BASE_URL)
+    return reply(_PING)
+
+def warm_connections():
+    # Open the trading + market-data sockets now so the first alert skips the TLS handshakes
+    try:
+        api.get_clock()
+        api.get_latest_trade("SPY")
+    except Exception as e:
+        log(f"⚠️ warm_connections: {e}")
+
+warm_connections()
+start_stream()
+restore_state()
 
 # ──────────────────────────────
 # RUN